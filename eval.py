@@ -1,242 +1,791 @@
 # SPDX-License-Identifier: Apache-2.0
 
+import argparse
+import atexit
+import concurrent.futures
 import dataclasses
 import difflib
-import optparse
+import functools
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Literal, Optional, TextIO
 
+import httpx
 import openai
 import termcolor
+import tiktoken
 
 PROMPT_FILE = "prompt.md"
 SAMPLES_DIR = "samples/"
-DSLX_INTERPRETER = "dslx_interpreter_main"
+# Resolved against $PATH once rather than on every interpreter spawn.
+DSLX_INTERPRETER = shutil.which("dslx_interpreter_main") or "dslx_interpreter_main"
 DSLX_STDLIB_PATH = os.environ['DSLX_STDLIB_PATH']
+LLM_CACHE_DIR = os.environ.get('DSLX_LLM_CACHE_DIR', os.path.join('data', 'llm_cache'))
+# When set to 1, interpreter output is kept for passing attempts too, not just failing ones.
+KEEP_ARTIFACTS = os.environ.get('DSLX_KEEP_ARTIFACTS') == '1'
 
 assert os.path.exists(os.path.join(DSLX_STDLIB_PATH, 'std.x'))
 
+@functools.cache
 def load_system_prompt() -> str:
-    # Load the system prompt
-    with open(PROMPT_FILE, "r") as f:
-        system_prompt = f.read()
+    # Load the system prompt (once; every CodeGenerator shares it)
+    system_prompt = Path(PROMPT_FILE).read_text()
 
     system_prompt += '\n\n**Important:** reply **only** with the DSLX code text that solves this problem, it will be piped **directly** to a DSLX interpreter! Do **not** apologize or explain! Do not write any tests as they may interfere with the (hidden) acceptance test suite. I will respond with any error text that might occur when running an acceptance test suite.\n'
     return system_prompt
 
-SYSTEM_PROMPT = load_system_prompt()
-
-def print_color_diff(text1: str, text2: str) -> None:
-    d = difflib.Differ()
-    diff = list(d.compare(text1.splitlines(), text2.splitlines()))
-
-    for line in diff:
-        if line.startswith("+ "):  # Added lines
-            print(termcolor.colored(line, "green"))
-        elif line.startswith("- "):  # Removed lines
-            print(termcolor.colored(line, "red"))
-        elif line.startswith("? "):  # Contextual hints
-            print(termcolor.colored(line, "yellow"))
-        else:  # Unchanged lines
-            print(line)
-
-def parse_sample(file_path: str) -> dict[str, str]:
-    """Parse the sample file to extract the prompt, signature, and tests."""
-    with open(file_path, "r") as f:
-        content = f.read()
-    sections: dict[str, list[str]] = {}
-    current_section: Optional[str] = None
-    for line in content.splitlines():
-        if line.startswith("## "):
-            current_section = line[3:].strip().lower()
-            sections[current_section] = []
-        elif current_section:
-            sections[current_section].append(line)
-    return {k: "\n".join(v).strip() for k, v in sections.items()}
+# Colors for unified diff lines keyed by their first character: added lines,
+# removed lines, and hunk headers. Unchanged lines are printed as-is.
+DIFF_LINE_COLORS: dict[str, Literal['green', 'red', 'yellow']] = {'+': 'green', '-': 'red', '@': 'yellow'}
+
+def print_color_diff(text1: str, text2: str, out: Optional[TextIO] = None) -> None:
+    # unified_diff avoids the per-line-pair similarity scoring that Differ does
+    # to produce its `? ` hint lines, which dominates on long programs.
+    diff = difflib.unified_diff(text1.splitlines(), text2.splitlines(), lineterm='')
+
+    # Skip the leading `---`/`+++` file header lines.
+    lines = []
+    for line in itertools.islice(diff, 2, None):
+        color = DIFF_LINE_COLORS.get(line[:1])
+        lines.append(termcolor.colored(line, color) if color else line)
+    if lines:
+        print('\n'.join(lines), file=out)
+
+# Matches a `## Section` header line; the capture is the section name.
+SECTION_HEADER_RE = re.compile(r'^## (.*)$', re.MULTILINE)
+
+def parse_sample(file_path: Path) -> dict[str, str]:
+    """Parse the sample file to extract the prompt, signature, and tests.
+
+    Results are memoized per (path, mtime); callers must not mutate them.
+    """
+    return _parse_sample_cached(file_path, file_path.stat().st_mtime)
+
+@functools.lru_cache(maxsize=256)
+def _parse_sample_cached(file_path: Path, mtime: float) -> dict[str, str]:
+    content = file_path.read_text()
+    # Splitting on the header pattern yields
+    # [preamble, name0, body0, name1, body1, ...]; text before the first
+    # header is not part of any section.
+    parts = SECTION_HEADER_RE.split(content)
+    return {name.strip().lower(): body.strip() for name, body in zip(parts[1::2], parts[2::2])}
+
+class LLMCache:
+    """Exact-match on-disk cache of assistant responses keyed on the request."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(chat_kwargs: dict) -> str:
+        blob = json.dumps(chat_kwargs, sort_keys=True)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key: str) -> Optional[list[str]]:
+        """Returns the cached response choices for `key`, if any."""
+        try:
+            with open(self._path(key), 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['choices']
+
+    def put(self, key: str, choices: list[str]) -> None:
+        # Write to a temporary file and rename so a concurrent reader never
+        # observes a partially written entry.
+        path = self._path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'choices': choices}, f)
+        os.replace(tmp_path, path)
+
+# Opt-in via DSLX_LLM_CACHE=1; useful for re-running a scorecard without paying
+# for identical requests again.
+LLM_CACHE: Optional[LLMCache] = LLMCache(LLM_CACHE_DIR) if os.environ.get('DSLX_LLM_CACHE') == '1' else None
+
+# Models that reject the `system` role; the system prompt is sent as a `user`
+# message for these.
+SYSTEM_ROLE_UNSUPPORTED_MODELS = frozenset(['o1-mini', 'o1-preview'])
+
+# Models that take a `reasoning_effort` parameter.
+REASONING_EFFORT_MODELS = frozenset(['o3-mini'])
+
+# Models that reject requests for more than one choice (`n` > 1).
+MULTIPLE_CHOICES_UNSUPPORTED_MODELS = frozenset(['o3-mini'])
+
+# Models that accept a `prediction` (Predicted Outputs) in chat completions.
+PREDICTED_OUTPUT_MODELS = frozenset(['gpt-4o', 'gpt-4o-mini'])
+
+@functools.cache
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Newer models may not be known to the installed tiktoken yet.
+        return tiktoken.get_encoding('o200k_base')
+
+@functools.lru_cache(maxsize=1024)
+def count_text_tokens(model: str, text: str) -> int:
+    # Messages include model replies and interpreter output, which may echo
+    # special-token text like `<|endoftext|>`; count it as plain text rather
+    # than letting `encode` reject it.
+    return len(get_encoding(model).encode_ordinary(text))
+
+def count_message_tokens(messages: list[dict], model: str) -> int:
+    """Approximates the prompt tokens for `messages`, including per-message framing."""
+    return sum(count_text_tokens(model, m["content"]) + 4 for m in messages)
+
+# Reasoning models can take minutes to respond, but a connection that can't be
+# established quickly should fail fast rather than stall a worker.
+OPENAI_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+# Sized so that every --parallelism worker can keep its connection alive.
+OPENAI_CONNECTION_LIMITS = httpx.Limits(max_connections=128, max_keepalive_connections=64)
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> openai.Client:
+    """Returns the process-wide OpenAI client so connections are reused across samples."""
+    http_client = openai.DefaultHttpxClient(timeout=OPENAI_TIMEOUT, limits=OPENAI_CONNECTION_LIMITS)
+    return openai.Client(http_client=http_client, timeout=OPENAI_TIMEOUT)
+
+class RateLimiter:
+    """Spaces out calls to `acquire` so at most `per_minute` return each minute.
+
+    Shared by all --parallelism workers so they stay under the account's
+    requests-per-minute limit instead of tripping 429s and backing off.
+    """
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
 class CodeGenerator:
-    def __init__(self, model: str, reasoning_effort: Optional[str], system_prompt: str):
-        """Initialize the CodeGenerator with a persistent OpenAI connection."""
-        self.client = openai.Client()
+    def __init__(self, model: str, reasoning_effort: Optional[str], system_prompt: str, max_history_turns: Optional[int] = None, feedback_model: Optional[str] = None, escalation_after: int = 2, initial_model: Optional[str] = None, max_prompt_tokens: Optional[int] = None, rate_limiter: Optional[RateLimiter] = None):
+        """Initialize the CodeGenerator with a persistent OpenAI connection.
+
+        If `max_history_turns` is given, only that many of the most recent
+        (response, feedback) exchanges are resent on each retry, in addition to
+        the system prompt and the original problem statement.
+
+        If `feedback_model` is given, the first `escalation_after` rounds of
+        error feedback are sent to it instead of `model`; later rounds escalate
+        back to `model`.
+
+        If `initial_model` is given, the first generation is sent to it instead
+        of `model`; feedback rounds fall back to `model` as above.
+
+        If `max_prompt_tokens` is given, the oldest (response, feedback)
+        exchanges are dropped before a request whose prompt would exceed it.
+
+        If `rate_limiter` is given, it is acquired before every API request.
+        """
+        self.client = get_client()
         self.model = model
         self.reasoning_effort = reasoning_effort
+        self.max_history_turns = max_history_turns
+        self.feedback_model = feedback_model
+        self.escalation_after = escalation_after
+        self.initial_model = initial_model
+        self.max_prompt_tokens = max_prompt_tokens
+        self.rate_limiter = rate_limiter
+        # Prompt token count of the most recent request, for reporting; only
+        # tracked when `max_prompt_tokens` is set.
+        self.last_prompt_tokens = 0
+        self._feedback_attempts = 0
+        models = {m for m in (model, feedback_model, initial_model) if m}
+        # Every request starts with the same system prompt; a stable cache key
+        # routes them to the same backend so the cached prefix is found.
+        self.prompt_cache_key = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:32]
+        # Only `messages` varies between requests; build the rest once.
+        self._base_chat_kwargs = {m: self._make_base_chat_kwargs(m) for m in models}
+        # The system prompt is the invariant prefix of every request; keeping it
+        # first lets the provider's automatic prompt caching reuse it.
+        system_role = "user" if models & SYSTEM_ROLE_UNSUPPORTED_MODELS else "system"
         self.messages = [
-            {"role": "user", "content": system_prompt}
+            {"role": system_role, "content": system_prompt}
         ]
 
-    def _get_chat_kwargs(self):
-        if self.model == 'o3-mini':
+    def _make_base_chat_kwargs(self, model: str) -> dict:
+        # The pinned openai client predates the `prompt_cache_key` argument, so
+        # it is passed through `extra_body`.
+        kwargs: dict = {'model': model, 'extra_body': {'prompt_cache_key': self.prompt_cache_key}}
+        if model in REASONING_EFFORT_MODELS:
             assert self.reasoning_effort is not None
-            return {
-                'model': 'o3-mini',
-                'reasoning_effort': self.reasoning_effort,
-                'messages': self.messages,
-            }
-        return {'model': self.model, 'messages': self.messages}
-
-    def generate_code(self, prompt, signature):
-        """Generate code using the OpenAI API and retain context for follow-ups."""
+            kwargs['reasoning_effort'] = self.reasoning_effort
+        return kwargs
+
+    def _get_chat_kwargs(self, model: str):
+        return {**self._base_chat_kwargs[model], 'messages': self.messages}
+
+    def _enforce_prompt_budget(self, model: str) -> None:
+        # Counting needs tiktoken's BPE data, so only do it when there's a budget.
+        if self.max_prompt_tokens is None:
+            return
+        self.last_prompt_tokens = count_message_tokens(self.messages, model)
+        # Keep the system prompt, the problem statement, and the latest exchange.
+        while self.last_prompt_tokens > self.max_prompt_tokens and len(self.messages) > 4:
+            del self.messages[2:4]
+            self.last_prompt_tokens = count_message_tokens(self.messages, model)
+
+    def _complete(self, model: str, prediction: Optional[str] = None, n: int = 1) -> list[str]:
+        """Requests `n` completions for the current history.
+
+        Returns all of them; the first is recorded as the reply in the history.
+        """
+        self._enforce_prompt_budget(model)
+        chat_kwargs = self._get_chat_kwargs(model)
+        if prediction is not None and model in PREDICTED_OUTPUT_MODELS:
+            chat_kwargs['prediction'] = {'type': 'content', 'content': prediction}
+        if n > 1:
+            chat_kwargs['n'] = n
+        cache_key = None
+        choices = None
+        if LLM_CACHE is not None:
+            cache_key = LLMCache.make_key(chat_kwargs)
+            choices = LLM_CACHE.get(cache_key)
+
+        if choices is None:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            # Stream the response so decoding overlaps with receiving it rather
+            # than waiting on a single blocking request for the full completion.
+            stream = self.client.chat.completions.create(**chat_kwargs, stream=True)
+            parts: list[list[str]] = [[] for _ in range(n)]
+            for chunk in stream:
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        parts[choice.index].append(choice.delta.content)
+            choices = [''.join(p).strip() for p in parts]
+            if LLM_CACHE is not None:
+                assert cache_key is not None
+                LLM_CACHE.put(cache_key, choices)
+
+        # Add the assistant response to the message history
+        self.messages.append({"role": "assistant", "content": choices[0]})
+        return choices
+
+    @staticmethod
+    def _problem_message(prompt, signature) -> dict:
+        return {"role": "user", "content": f"{prompt}\n\nSignature:\n{signature}"}
+
+    def get_generate_request(self, prompt, signature) -> dict:
+        """Returns the chat completion kwargs `generate_code` would send, without sending them."""
+        chat_kwargs = self._get_chat_kwargs(self.initial_model or self.model)
+        chat_kwargs['messages'] = self.messages + [self._problem_message(prompt, signature)]
+        return chat_kwargs
+
+    def generate_code(self, prompt, signature, response: Optional[str] = None):
+        """Generate code using the OpenAI API and retain context for follow-ups.
+
+        If `response` is given (e.g. obtained via the Batch API) it is recorded
+        as the assistant reply instead of making a request.
+        """
         # Add user prompt to the message history
-        self.messages.append({"role": "user", "content": f"{prompt}\n\nSignature:\n{signature}"})
+        self.messages.append(self._problem_message(prompt, signature))
+        self._feedback_attempts = 0
+
+        if response is not None:
+            self.messages.append({"role": "assistant", "content": response})
+            return response
+        return self._complete(self.initial_model or self.model)[0]
 
-        # Make the API call
-        response = self.client.chat.completions.create(
-            **self._get_chat_kwargs()
-        )
+    def generate_candidates(self, prompt, signature, n: int) -> list[str]:
+        """Like `generate_code`, but requests `n` alternative completions in one call.
 
-        # Capture assistant response and add it to the message history
-        assistant_response = response.choices[0].message.content.strip()
-        self.messages.append({"role": "assistant", "content": assistant_response})
+        The prompt prefill is paid once for all candidates. The conversation
+        continues from the first candidate.
+        """
+        self.messages.append(self._problem_message(prompt, signature))
+        self._feedback_attempts = 0
 
-        return assistant_response
+        model = self.initial_model or self.model
+        if model in MULTIPLE_CHOICES_UNSUPPORTED_MODELS:
+            n = 1
+        return self._complete(model, n=n)
 
     def provide_feedback(self, error_message):
         """Feed follow-up errors back into the conversation."""
         # Add the error message as a user input to the message history
         self.messages.append({"role": "user", "content": f"Error encountered:\n{error_message}"})
-
-        # Make the API call
-        response = self.client.chat.completions.create(
-            **self._get_chat_kwargs()
-        )
-
-        # Capture assistant response and add it to the message history
-        assistant_response = response.choices[0].message.content.strip()
-        self.messages.append({"role": "assistant", "content": assistant_response})
-
-        return assistant_response
+        self._trim_history()
+
+        # Route early (typically small syntactic) fixups to the cheaper feedback
+        # model, escalating to the primary model if they keep failing.
+        self._feedback_attempts += 1
+        model = self.model
+        if self.feedback_model is not None and self._feedback_attempts <= self.escalation_after:
+            model = self.feedback_model
+        # A fix usually leaves most of the previous response intact, so offer it
+        # as a predicted output to speed up decoding.
+        prior_response = next((m["content"] for m in reversed(self.messages) if m["role"] == "assistant"), None)
+        return self._complete(model, prediction=prior_response)[0]
+
+    def _trim_history(self) -> None:
+        """Drops the oldest exchanges beyond `max_history_turns`."""
+        if self.max_history_turns is None:
+            return
+        # messages[0] is the system prompt and messages[1] the problem statement;
+        # the rest alternates assistant response / user feedback.
+        keep = 2 * self.max_history_turns
+        if len(self.messages) - 2 > keep:
+            self.messages[2:] = self.messages[len(self.messages) - keep:]
 
 def strip_fences(text: str) -> str:
     text = text.strip()
-    if text.startswith('```'):
-        lines = text.splitlines()
-        assert lines[-1] == '```'
-        text = '\n'.join(lines[1:-1])
-    return text
+    if not text.startswith('```'):
+        return text
+    # Locate the opening and closing fence lines directly instead of splitting
+    # the whole response into a list of lines.
+    end = text.rfind('\n')
+    assert text[end + 1:] == '```'
+    if end < 0:
+        return ''
+    start = text.find('\n') + 1
+    return text[start:end]
+
+# Matches ANSI terminal escape sequences, e.g. colors in interpreter output.
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# Matches the two-line report of a test that passed, e.g.
+#   [ RUN UNITTEST  ] test_foo
+#   [            OK ]
+PASSED_TEST_RE = re.compile(r'^\[ RUN [A-Z]+ *\] .*\n\[ +OK \]\n?', re.MULTILINE)
+
+def summarize_stderr(text: str, max_lines: int = 40, max_chars: int = 4000) -> str:
+    """Condenses interpreter stderr before it is fed back to the model.
+
+    Strips ANSI escapes, drops the reports of tests that passed, collapses runs
+    of identical lines into a single line with a repeat count, and truncates to
+    `max_lines` / `max_chars`.
+    """
+    text = PASSED_TEST_RE.sub('', ANSI_ESCAPE_RE.sub('', text))
+    lines = []
+    for line, group in itertools.groupby(text.splitlines()):
+        count = sum(1 for _ in group)
+        lines.append(line if count == 1 else f'{line} (x{count})')
+    summary = '\n'.join(lines[:max_lines])
+    if len(lines) > max_lines or len(summary) > max_chars:
+        summary = summary[:max_chars] + '\n...(truncated)'
+    return summary
 
 @dataclasses.dataclass
 class RunResult:
     command: str
     success: bool
     retcode: int
-    stdout: str
-    stderr: str
-
-def run_dslx_tests(generated_code: str, test_cases: str, sample_filename: str, tmpdir: str) -> RunResult:
-    """Run DSLX tests using the interpreter."""
-    prologue_lines = []
-    if 'import std;' not in generated_code:
-        prologue_lines.append('import std;')
-
-    full_code = '\n'.join(prologue_lines) + '\n\n' + strip_fences(generated_code) + "\n\n// -- tests\n\n" + strip_fences(test_cases)
+    # Captured as raw bytes; successful runs never need them decoded.
+    stdout: bytes
+    stderr: bytes
+
+    @property
+    def stderr_text(self) -> str:
+        return self.stderr.decode('utf-8', errors='replace')
+
+# Matches an `import std;` statement at the start of a line (so a commented-out
+# import doesn't count).
+IMPORT_STD_RE = re.compile(r'^\s*import\s+std\s*;', re.MULTILINE)
+
+# Captures the name of each function defined (or declared, in a signature).
+FN_NAME_RE = re.compile(r'\bfn[ \t]+(\w+)')
+
+# Cap on the interpreter output kept per stream for each run.
+MAX_CAPTURED_OUTPUT_BYTES = 1 << 20
+
+def read_captured_output(f: BinaryIO) -> bytes:
+    """Reads at most MAX_CAPTURED_OUTPUT_BYTES of a captured output stream."""
+    f.seek(0)
+    data = f.read(MAX_CAPTURED_OUTPUT_BYTES + 1)
+    if len(data) > MAX_CAPTURED_OUTPUT_BYTES:
+        data = data[:MAX_CAPTURED_OUTPUT_BYTES] + b'\n...(truncated)\n'
+    return data
+
+# By default tests run in the DSLX interpreter and are cross-checked against
+# the JIT, which runs each test twice but gives the most precise diagnostics.
+# With `jit_only` they run once, under the JIT alone.
+CROSS_CHECK_EVALUATOR_FLAGS = ['--compare=jit']
+JIT_ONLY_EVALUATOR_FLAGS = ['--evaluator=ir-jit', '--compare=none']
+
+def run_dslx_tests(code: str, test_code: str, sample_filename: str, tmpdir: str, required_functions: tuple[str, ...] = (), jit_only: bool = False, run_cache: Optional[dict[str, RunResult]] = None) -> RunResult:
+    """Run DSLX tests using the interpreter.
+
+    `code` and `test_code` are the generated code and the sample's test
+    section with their fences already stripped.
+
+    If `code` doesn't define all of `required_functions` (e.g. the model
+    replied with prose), a failure naming them is returned without running
+    the interpreter.
+
+    If `run_cache` is given, results are memoized in it keyed on the hash of
+    the program text and flags. Callers scope it to a single sample: the key
+    includes the sample's tests, so entries can't be hit by other samples.
+    """
+    defined = set(FN_NAME_RE.findall(code))
+    missing = [name for name in required_functions if name not in defined]
+    if missing:
+        message = f'error: no definition found for {", ".join(f"`{name}`" for name in missing)}; reply with DSLX code that defines the requested signature\n'
+        return RunResult('(interpreter not run)', False, -1, b'', message.encode('utf-8'))
+
+    prologue = '' if IMPORT_STD_RE.search(code) else 'import std;'
+    full_code = ''.join([prologue, '\n\n', code, '\n\n// -- tests\n\n', test_code]).encode('utf-8')
     x_path = os.path.join(tmpdir, sample_filename + ".x")
-    with open(x_path, "w") as f:
-        f.write(full_code)
-
-    cmd = [DSLX_INTERPRETER, x_path, '--dslx_stdlib_path', DSLX_STDLIB_PATH, '--compare=jit']
-    result = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    success = result.returncode == 0
+    Path(x_path).write_bytes(full_code)
+
+    flags = ['--dslx_stdlib_path', DSLX_STDLIB_PATH] + (JIT_ONLY_EVALUATOR_FLAGS if jit_only else CROSS_CHECK_EVALUATOR_FLAGS)
+    cmd = [DSLX_INTERPRETER, x_path] + flags
     command = subprocess.list2cmdline(cmd)
-    return RunResult(command, success, result.returncode, result.stdout, result.stderr)
 
-def evaluate_sample(sample_path: str, model: str, reasoning_effort: Optional[str], max_retries: int) -> tuple[bool, bool]:
-    """Evaluate a single sample."""
-    _, sample_filename = os.path.split(sample_path)
-    sample_filename, _ = os.path.splitext(sample_filename)
+    # Models often resubmit the same program on a retry; the interpreter is
+    # deterministic, so reuse the earlier result instead of re-running it.
+    cache_key = hashlib.sha256(full_code + '\0'.join([''] + flags).encode('utf-8')).hexdigest()
+    cached = run_cache.get(cache_key) if run_cache is not None else None
+    if cached is not None:
+        return dataclasses.replace(cached, command=command)
+
+    # Send output to temporary files rather than pipes so a run that dumps huge
+    # traces can't grow our memory unboundedly; only a bounded prefix is kept.
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+        result = subprocess.run(cmd, stdout=stdout_file, stderr=stderr_file)
+        stdout = read_captured_output(stdout_file)
+        stderr = read_captured_output(stderr_file)
+    success = result.returncode == 0
+    run_result = RunResult(command, success, result.returncode, stdout, stderr)
+    if run_cache is not None:
+        run_cache[cache_key] = run_result
+    return run_result
+
+# Writes the per-attempt result files in the background so the retry loop
+# doesn't wait on the filesystem; evaluate_sample waits for (and re-raises
+# errors from) its writes before returning.
+RESULT_WRITER = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+atexit.register(RESULT_WRITER.shutdown)
+
+def write_attempt_results(run_result: RunResult, path_prefix: str) -> None:
+    """Persists an attempt's retcode and any non-empty interpreter output.
+
+    Output of passing attempts is only kept if `KEEP_ARTIFACTS` is set.
+    """
+    Path(path_prefix + '-retcode.txt').write_text(f'{run_result.retcode}\n')
+    if run_result.success and not KEEP_ARTIFACTS:
+        return
+    for suffix, data in (('-stdout.txt', run_result.stdout), ('-stderr.txt', run_result.stderr)):
+        if data:
+            Path(path_prefix + suffix).write_bytes(data)
+
+def pick_initial_model(prompt: str, fast_model: Optional[str], fast_model_max_words: int) -> Optional[str]:
+    """Returns `fast_model` for short (presumed easy) prompts, else None."""
+    if fast_model is not None and len(prompt.split()) <= fast_model_max_words:
+        return fast_model
+    return None
+
+@dataclasses.dataclass(frozen=True)
+class EvalOptions:
+    """Settings shared by every sample in an evaluation run."""
+    model: str
+    reasoning_effort: Optional[str]
+    max_retries: int
+    max_history_turns: Optional[int] = None
+    feedback_model: Optional[str] = None
+    escalation_after: int = 2
+    fast_model: Optional[str] = None
+    fast_model_max_words: int = 40
+    max_prompt_tokens: Optional[int] = None
+    candidates: int = 1
+    quiet: bool = False
+    rate_limiter: Optional[RateLimiter] = None
+    jit_only: bool = False
+
+def make_code_generator(prompt: str, options: EvalOptions) -> CodeGenerator:
+    initial_model = pick_initial_model(prompt, options.fast_model, options.fast_model_max_words)
+    return CodeGenerator(options.model, options.reasoning_effort, load_system_prompt(), options.max_history_turns, options.feedback_model, options.escalation_after, initial_model, options.max_prompt_tokens, options.rate_limiter)
+
+def evaluate_sample(sample_path: Path, options: EvalOptions, out: Optional[TextIO] = None, first_response: Optional[str] = None) -> tuple[bool, bool]:
+    """Evaluate a single sample, logging progress to `out` (default stdout).
+
+    If `first_response` is given it is used as the model's first attempt
+    instead of querying the model (see `run_batch`).
+    """
+    pending_writes: list[concurrent.futures.Future] = []
+    try:
+        return _evaluate_sample(sample_path, options, out, first_response, pending_writes)
+    finally:
+        # Surface a failed result write (e.g. a full disk) rather than losing it.
+        for future in pending_writes:
+            future.result()
+
+def _evaluate_sample(sample_path: Path, options: EvalOptions, out: Optional[TextIO], first_response: Optional[str], pending_writes: list[concurrent.futures.Future]) -> tuple[bool, bool]:
+    sample_filename = sample_path.stem
 
     sample = parse_sample(sample_path)
     prompt, signature, tests = sample["prompt"], sample["signature"], sample["tests"]
-    codegen = CodeGenerator(model, reasoning_effort, SYSTEM_PROMPT)
+    test_code = strip_fences(tests)
+    required_functions = tuple(FN_NAME_RE.findall(signature))
+    codegen = make_code_generator(prompt, options)
+    if codegen.initial_model is not None:
+        print(f'routing first attempt to {codegen.initial_model}', file=out)
 
-    with tempfile.TemporaryDirectory(suffix=f'-{model}-{sample_filename}', delete=False) as tmpdir:
-        print('tmpdir:', tmpdir)
+    with tempfile.TemporaryDirectory(suffix=f'-{options.model}-{sample_filename}', delete=False) as tmpdir:
+        print('tmpdir:', tmpdir, file=out)
 
-        all_generated = []
+        previous_generated: Optional[str] = None
+        run_cache: dict[str, RunResult] = {}
+        seen_errors: set[bytes] = set()
 
         feedback_from_last_iteration = None
         first_attempt_success = False
-        for attempt in range(1, max_retries + 1):
-            print(f"🤖 Attempt {attempt}:")
+        for attempt in range(1, options.max_retries + 1):
+            print(f"🤖 Attempt {attempt}:", file=out)
             if feedback_from_last_iteration is not None:
-                generated_code = codegen.provide_feedback('```\n' + feedback_from_last_iteration + '\n```\n')
+                candidates = [codegen.provide_feedback(feedback_from_last_iteration)]
+            elif first_response is None and options.candidates > 1:
+                candidates = codegen.generate_candidates(prompt, signature, options.candidates)
             else:
-                generated_code = codegen.generate_code(prompt, signature)
+                candidates = [codegen.generate_code(prompt, signature, first_response)]
+            generated_code = candidates[0]
 
-            all_generated.append(generated_code)
+            if codegen.last_prompt_tokens:
+                print(f'prompt tokens: {codegen.last_prompt_tokens}', file=out)
 
-            termcolor.cprint('<<GENERATED', color='blue')
-            print(generated_code)
-            termcolor.cprint('GENERATED', color='blue')
+            if not options.quiet:
+                termcolor.cprint('<<GENERATED', color='blue', file=out)
+                print(generated_code, file=out)
+                termcolor.cprint('GENERATED', color='blue', file=out)
 
-            if len(all_generated) >= 2:
-                termcolor.cprint('<<DIFF', color='blue')
-                print_color_diff(all_generated[-2], all_generated[-1])
-                termcolor.cprint('DIFF', color='blue')
+            unchanged = generated_code == previous_generated
+            if previous_generated is not None and not unchanged and not options.quiet:
+                termcolor.cprint('<<DIFF', color='blue', file=out)
+                print_color_diff(previous_generated, generated_code, out)
+                termcolor.cprint('DIFF', color='blue', file=out)
+            previous_generated = generated_code
 
-            run_result = run_dslx_tests(generated_code, tests, f'{sample_filename}-attempt-{attempt}', tmpdir)
+            if unchanged:
+                # run_cache serves the identical program without re-running the interpreter.
+                print('Code unchanged from the previous attempt; reusing its result.', file=out)
+            run_result = run_dslx_tests(strip_fences(generated_code), test_code, f'{sample_filename}-attempt-{attempt}', tmpdir, required_functions, options.jit_only, run_cache)
 
             # Write out results to the tmpdir as well.
-            with open(os.path.join(tmpdir, f'{sample_filename}-attempt-{attempt}-result-retcode.txt'), 'w') as f:
-                print(run_result.retcode, file=f)
-            with open(os.path.join(tmpdir, f'{sample_filename}-attempt-{attempt}-result-stdout.txt'), 'w') as f:
-                f.write(run_result.stdout)
-            with open(os.path.join(tmpdir, f'{sample_filename}-attempt-{attempt}-result-stderr.txt'), 'w') as f:
-                f.write(run_result.stderr)
+            pending_writes.append(RESULT_WRITER.submit(write_attempt_results, run_result, os.path.join(tmpdir, f'{sample_filename}-attempt-{attempt}-result')))
 
             if run_result.success:
-                print(f"✅ Success on attempt {attempt}")
+                print(f"✅ Success on attempt {attempt}", file=out)
                 if attempt == 1:
                     first_attempt_success = True
                 return True, first_attempt_success
 
-            print(f"❌ Error on attempt {attempt}; command: {run_result.command}")
-
-            termcolor.cprint('<<OUTPUT', color='blue')
-            print(run_result.stderr, end='')
-            termcolor.cprint('OUTPUT', color='blue')
-
-            feedback_from_last_iteration = run_result.stderr
-
-    print("❌ All attempts failed.")
+            print(f"❌ Error on attempt {attempt}; command: {run_result.command}", file=out)
+
+            stderr = run_result.stderr_text
+            if not options.quiet:
+                termcolor.cprint('<<OUTPUT', color='blue', file=out)
+                print(stderr, end='', file=out)
+                termcolor.cprint('OUTPUT', color='blue', file=out)
+
+            # Alternative candidates are only tested; the conversation (and so
+            # any feedback) continues from the first one.
+            for index, candidate in enumerate(candidates[1:], start=2):
+                if not options.quiet:
+                    termcolor.cprint(f'<<CANDIDATE {index}', color='blue', file=out)
+                    print(candidate, file=out)
+                    termcolor.cprint(f'CANDIDATE {index}', color='blue', file=out)
+                candidate_result = run_dslx_tests(strip_fences(candidate), test_code, f'{sample_filename}-attempt-{attempt}-candidate-{index}', tmpdir, required_functions, options.jit_only, run_cache)
+                pending_writes.append(RESULT_WRITER.submit(write_attempt_results, candidate_result, os.path.join(tmpdir, f'{sample_filename}-attempt-{attempt}-candidate-{index}-result')))
+                if candidate_result.success:
+                    print(f"✅ Success on attempt {attempt} (candidate {index})", file=out)
+                    return True, attempt == 1
+                print(f"❌ Candidate {index} failed too", file=out)
+
+            feedback_from_last_iteration = '```\n' + summarize_stderr(stderr) + '\n```\n'
+            # Diagnostics name the per-attempt `.x` file, so leave it out of the comparison.
+            error_text = re.sub(re.escape(sample_filename) + r'-attempt-\d+\.x', '', stderr)
+            error_digest = hashlib.blake2b(error_text.encode('utf-8'), digest_size=16).digest()
+            if error_digest in seen_errors:
+                # Sending the same error back tends to get the same fix back.
+                feedback_from_last_iteration = 'Same error as a previous attempt; try a different approach.\n' + feedback_from_last_iteration
+            seen_errors.add(error_digest)
+
+    print("❌ All attempts failed.", file=out)
     return False, first_attempt_success
 
+BATCH_TERMINAL_STATUSES = frozenset(['completed', 'failed', 'expired', 'cancelled'])
+
+def run_batch(requests: dict[str, dict]) -> dict[str, str]:
+    """Runs chat completion requests through the OpenAI Batch API.
+
+    `requests` maps a custom id to the kwargs for `chat.completions.create`.
+    Blocks until the batch finishes and returns the assistant response for
+    each request that succeeded, keyed by custom id.
+    """
+    client = get_client()
+    lines = []
+    for custom_id, kwargs in requests.items():
+        # `extra_body` is a client-side escape hatch; its fields go in the body.
+        body = {k: v for k, v in kwargs.items() if k != 'extra_body'}
+        body.update(kwargs.get('extra_body', {}))
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}))
+    jsonl = '\n'.join(lines)
+    input_file = client.files.create(file=('batch.jsonl', jsonl.encode('utf-8')), purpose='batch')
+    batch = client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+    print(f'Submitted batch {batch.id} with {len(requests)} requests')
+
+    delay = 5.0
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(delay)
+        delay = min(delay * 2, 300.0)
+        batch = client.batches.retrieve(batch.id)
+        print(f'Batch {batch.id}: {batch.status}')
+
+    if batch.output_file_id is None:
+        print(f'Batch {batch.id} produced no output (status: {batch.status})')
+        return {}
+
+    responses = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        record = json.loads(line)
+        response = record.get('response')
+        if record.get('error') or response is None or response['status_code'] != 200:
+            continue
+        responses[record['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+    return responses
+
+@functools.cache
+def get_sample_files() -> list[Path]:
+    """Returns the sample markdown files, sorted by name."""
+    # DirEntry caches the file type from the directory read, so no extra stat
+    # is needed per entry.
+    with os.scandir(SAMPLES_DIR) as entries:
+        return sorted(Path(entry.path) for entry in entries if entry.name.endswith('.md') and entry.is_file())
+
 def get_sample_choices() -> list[str]:
-    return [os.path.splitext(filename)[0] for filename in os.listdir(SAMPLES_DIR)]
+    return [path.stem for path in get_sample_files()]
 
 def main():
     """Main function to evaluate all samples."""
     MODEL_CHOICES = ['gpt-3.5-turbo', 'gpt-4o-mini', 'gpt-4o', 'o1-mini', 'o1-preview', 'o3-mini']
 
-    parser = optparse.OptionParser()
-    parser.add_option('--model', default=None, choices=MODEL_CHOICES, help='choose a model to query; choices: %s' % '|'.join(MODEL_CHOICES))
-    parser.add_option('--sample', default=None, choices=get_sample_choices())
-    parser.add_option('--max-retries', default=3, type=int)
-    parser.add_option('--reasoning-effort', default=None, choices=['low', 'medium', 'high'], help='choose a reasoning effort; choices: %s' % '|'.join(['low', 'medium', 'high']))
-    opts, args = parser.parse_args()
-
-    if args:
-        parser.error('No args are expected')
-    if opts.model is None:
-        parser.error('--model is required')
-
-    sample_files = list(Path(SAMPLES_DIR).glob("*.md"))
+    # argparse lists the choices in --help itself.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, choices=MODEL_CHOICES, help='choose a model to query')
+    parser.add_argument('--sample', default=None, help='only evaluate this sample (file stem under samples/)')
+    parser.add_argument('--max-retries', default=3, type=int)
+    parser.add_argument('--parallelism', default=1, type=int, help='number of samples to evaluate concurrently')
+    parser.add_argument('--max-requests-per-minute', default=None, type=int, help='cap the rate of model requests across all parallel workers')
+    parser.add_argument('--max-history-turns', default=None, type=int, help='only resend this many (at least 1) of the most recent response/feedback exchanges on retry')
+    parser.add_argument('--feedback-model', default=None, choices=MODEL_CHOICES, help='model to send the first error-feedback rounds to')
+    parser.add_argument('--escalation-after', default=2, type=int, help='number of feedback rounds sent to --feedback-model before escalating back to --model')
+    parser.add_argument('--fast-model', default=None, choices=MODEL_CHOICES, help='model to send the first attempt of short prompts to')
+    parser.add_argument('--fast-model-max-words', default=40, type=int, help='prompts with at most this many words are routed to --fast-model')
+    parser.add_argument('--candidates', default=1, type=int, help='request this many alternative first-attempt completions in a single API call and test each')
+    parser.add_argument('--max-prompt-tokens', default=None, type=int, help='drop the oldest response/feedback exchanges when a request would exceed this many prompt tokens')
+    parser.add_argument('--jit-only', action='store_true', help='run the acceptance tests once under the JIT instead of cross-checking the interpreter against it')
+    parser.add_argument('--quiet', action='store_true', help='only log attempt outcomes, not the generated code, diffs, or interpreter output')
+    parser.add_argument('--batch', action='store_true', help='submit all first attempts via the (slower, cheaper) Batch API; retries are made synchronously')
+    parser.add_argument('--reasoning-effort', default=None, choices=['low', 'medium', 'high'], help='choose a reasoning effort')
+    opts = parser.parse_args()
+
+    # Zero turns would drop the very feedback being sent.
+    if opts.max_history_turns is not None and opts.max_history_turns < 1:
+        parser.error('--max-history-turns must be at least 1')
+    # Batch requests carry a single first-attempt completion per sample.
+    if opts.batch and opts.candidates > 1:
+        parser.error('--candidates cannot be combined with --batch')
+    # Checked up front: a --fast-model generator is only built once a short
+    # prompt comes up, possibly well into a (paid) run.
+    if opts.reasoning_effort is None:
+        for flag, model in (('--model', opts.model), ('--feedback-model', opts.feedback_model), ('--fast-model', opts.fast_model)):
+            if model in REASONING_EFFORT_MODELS:
+                parser.error(f'{flag} {model} requires --reasoning-effort')
 
     if opts.sample:
-        sample_files = [os.path.join(SAMPLES_DIR, opts.sample + '.md')]
+        # Checked here rather than via `choices` so the samples directory is
+        # only listed when the name is wrong.
+        sample_file = Path(SAMPLES_DIR, opts.sample + '.md')
+        if not sample_file.is_file():
+            parser.error(f'invalid --sample {opts.sample!r} (choose from {", ".join(get_sample_choices())})')
+        sample_files = [sample_file]
+    else:
+        sample_files = get_sample_files()
+
+    options = EvalOptions(
+        model=opts.model,
+        reasoning_effort=opts.reasoning_effort,
+        max_retries=opts.max_retries,
+        max_history_turns=opts.max_history_turns,
+        feedback_model=opts.feedback_model,
+        escalation_after=opts.escalation_after,
+        fast_model=opts.fast_model,
+        fast_model_max_words=opts.fast_model_max_words,
+        max_prompt_tokens=opts.max_prompt_tokens,
+        candidates=opts.candidates,
+        quiet=opts.quiet,
+        jit_only=opts.jit_only,
+        rate_limiter=RateLimiter(opts.max_requests_per_minute) if opts.max_requests_per_minute else None,
+    )
 
-    results = {}
+    # First attempts don't depend on anything but the sample, so in batch mode
+    # they are all submitted up front; any that fail in the batch fall back to
+    # a synchronous request.
+    first_responses: dict[str, str] = {}
+    if opts.batch:
+        requests = {}
+        for sample_file in sample_files:
+            sample = parse_sample(sample_file)
+            codegen = make_code_generator(sample["prompt"], options)
+            requests[sample_file.stem] = codegen.get_generate_request(sample["prompt"], sample["signature"])
+        first_responses = run_batch(requests)
+
+    def evaluate(sample_file: Path, out: Optional[TextIO] = None) -> tuple[bool, bool]:
+        print(f"Evaluating {sample_file}...", file=out)
+        return evaluate_sample(sample_file, options, out, first_responses.get(sample_file.stem))
+
+    outcomes: dict = {}
+    if opts.parallelism <= 1:
+        for sample_file in sample_files:
+            outcomes[sample_file] = evaluate(sample_file)
+    else:
+        # Samples are dominated by waiting on the API and the interpreter, so run
+        # them on a thread pool. Each sample logs into its own buffer which is
+        # printed whole when it finishes, to keep the output readable.
+        def evaluate_buffered(sample_file: Path) -> tuple[tuple[bool, bool], str]:
+            out = io.StringIO()
+            outcome = evaluate(sample_file, out)
+            return outcome, out.getvalue()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=opts.parallelism) as executor:
+            futures = {executor.submit(evaluate_buffered, sample_file): sample_file for sample_file in sample_files}
+            for future in concurrent.futures.as_completed(futures):
+                outcome, log = future.result()
+                print(log, end='')
+                outcomes[futures[future]] = outcome
 
+    results = {}
     for sample_file in sample_files:
-        print(f"Evaluating {sample_file}...")
-        success, first_attempt_success = evaluate_sample(sample_file, opts.model, opts.reasoning_effort, opts.max_retries)
+        success, first_attempt_success = outcomes[sample_file]
         results[sample_file] = {
             "success": success,
             "first_attempt_success": first_attempt_success,
@@ -260,8 +809,13 @@ def main():
 
     print("\nSummary:")
     print(f"Total Samples: {total_samples}")
-    print(f"Pass Rate (First Attempt): {first_attempt_success_count / total_samples:.2%}")
+    # A first attempt passes if any of its candidates does, so with several
+    # candidates this is pass@N; say so to keep scorecards comparable.
+    first_attempt_label = f"First Attempt, pass@{options.candidates}" if options.candidates > 1 else "First Attempt"
+    print(f"Pass Rate ({first_attempt_label}): {first_attempt_success_count / total_samples:.2%}")
     print(f"Pass Rate (All Attempts): {total_success / total_samples:.2%}")
+    if LLM_CACHE is not None:
+        print(f"LLM Cache: {LLM_CACHE.hits} hits, {LLM_CACHE.misses} misses")
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,17 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import dataclasses
+import hashlib
 import os
 import re
-import tempfile
 import subprocess
 import sys
+from pathlib import Path
 
 import pytest
-import tiktoken
 
 PROMPT_MD_FILE = 'prompt.md'
+SAMPLES_DIR = Path('samples')
 
 assert 'DSLX_STDLIB_PATH' in os.environ, 'Please add DSLX_STDLIB_PATH to your environment variables; e.g. `export DSLX_STDLIB_PATH=$HOME/opt/xlsynth/latest/xls/dslx/stdlib/`'
 
@@ -20,12 +21,24 @@ CODE_FENCE_RE = re.compile(
     re.DOTALL | re.MULTILINE
 )
 
-def extract_dslx_code_samples(md_file):
-    """Extracts all code samples labeled 'dslx' from the markdown file."""
-    with open(md_file, 'r') as f:
-        md_content = f.read()
-    code_samples = CODE_FENCE_RE.findall(md_content)
-    return code_samples
+# A `## Section` header line in a sample; the capture is the section name.
+SECTION_HEADER_RE = re.compile(r'^## (.+?)[ \t]*\n', re.MULTILINE)
+
+# Return type in a function signature, i.e. everything after the arrow.
+RETURN_TYPE_RE = re.compile(r'->\s*(.*)')
+
+# Captures the name of each function defined (or declared, in a signature).
+FN_NAME_RE = re.compile(r'\bfn[ \t]+(\w+)')
+
+def split_sections(md_content: str) -> dict[str, str]:
+    """Splits a sample into its section bodies, keyed by section name."""
+    parts = SECTION_HEADER_RE.split(md_content)
+    # parts is [preamble, name1, body1, name2, body2, ...]
+    return dict(zip(parts[1::2], parts[2::2]))
+
+def extract_dslx_code_samples(md_content: str) -> list[str]:
+    """Extracts all code samples labeled 'dslx' from the markdown text."""
+    return CODE_FENCE_RE.findall(md_content)
 
 
 @dataclasses.dataclass
@@ -36,23 +49,21 @@ class CodeSample:
 
 def create_sample_with_stub(filename: str, md_content: str) -> CodeSample:
     """Creates a sample with a stub for the DSLX code sample."""
+    sections = split_sections(md_content)
+
     # Extract the signature -- it lives in the subsection called '## Signature'
     # Within a fence in that section marked '```dslx-snippet'
-    signature_re = re.compile(r'^## Signature\s*\n(.*?)^##', re.DOTALL | re.MULTILINE)
-    signature_match = signature_re.search(md_content)
-    if not signature_match:
+    if 'Signature' not in sections:
         raise ValueError(f'No signature found in {filename}')
-    signature = signature_match.group(1)
+    signature = sections['Signature']
     signature = signature.replace('```dslx-snippet', '')
     signature = signature.replace('```', '')
     signature = signature.strip()
     signatures = signature.splitlines()
 
     # See if there is a Prologue section, if so we extract that to include before the stubs.
-    prologue_re = re.compile(r'^## Prologue\s*\n(.*?)^##', re.DOTALL | re.MULTILINE)
-    prologue_match = prologue_re.search(md_content)
-    if prologue_match:
-        prologue = prologue_match.group(1)
+    if 'Prologue' in sections:
+        prologue = sections['Prologue']
         prologue = prologue.replace('```dslx', '')
         prologue = prologue.replace('```', '')
         prologue = prologue.strip()
@@ -62,27 +73,27 @@ def create_sample_with_stub(filename: str, md_content: str) -> CodeSample:
     # Extract the tests -- they live in the subsection called '## Tests'
     # That should be the last subsection in the file.
     # The test content lives inside of a fence marked '```dslx'
-    tests_re = re.compile(r'^## Tests\n(.*)', re.DOTALL | re.MULTILINE)
-    tests_match = tests_re.search(md_content)
-    if not tests_match:
+    if 'Tests' not in sections:
         raise ValueError(f'No tests found in {filename}')
-    tests = tests_match.group(1)
+    tests = sections['Tests']
     assert 'dslx-snippet' in tests, f'No dslx-snippet found in {filename}'
     tests = tests.replace('```dslx-snippet', '')
     tests = tests.replace('```', '')
     tests = tests.strip()
 
-    # Create a stub for the signature that looks like:
+    # Create a stub for each signature that looks like:
     # $SIGNATURE { fail!("unimplemented", zero!<ReturnType>()) }
     # This means we have to hackily parse the return type out of the signature, but that's not too bad because it's after the arrow.
-    return_type_re = re.compile(r'->\s*(.*)')
-    return_type_match = return_type_re.search(signature)
-    if not return_type_match:
-        raise ValueError(f'No return type found in {filename}')
-    return_type = return_type_match.group(1)
-
+    # Functions the prologue already defines need no stub (it would be a redefinition).
+    prologue_functions = set(FN_NAME_RE.findall(prologue))
     stub_lines: list[str] = []
     for signature in signatures:
+        if set(FN_NAME_RE.findall(signature)) <= prologue_functions:
+            continue
+        return_type_match = RETURN_TYPE_RE.search(signature)
+        if not return_type_match:
+            raise ValueError(f'No return type found in {filename}')
+        return_type = return_type_match.group(1)
         stub_lines.append(f'{signature} {{ fail!("unimplemented", zero!<{return_type}>()) }}\n')
     stubs: str = '\n'.join(stub_lines)
 
@@ -91,67 +102,64 @@ def create_sample_with_stub(filename: str, md_content: str) -> CodeSample:
 
 def create_samples_with_stubs() -> list[CodeSample]:
     """Creates samples with stubs for each DSLX code sample."""
-    results = []
-    for filename in os.listdir('samples'):
-        if not filename.endswith('.md'):
-            continue
-        with open(f'samples/{filename}', 'r') as f:
-            md_content = f.read()
-        results.append(create_sample_with_stub(filename, md_content))
-    return results
+    return [create_sample_with_stub(path.name, path.read_text()) for path in sorted(SAMPLES_DIR.glob('*.md'))]
 
 
-# Extract code samples from the markdown file
-PROMPT_CODE_SAMPLES = extract_dslx_code_samples(PROMPT_MD_FILE)
+# Extract code samples from the markdown file; it's read once, and both the
+# code samples and the prompt-size check derive from it.
+PROMPT_MD_TEXT = Path(PROMPT_MD_FILE).read_text(encoding='utf-8')
+PROMPT_CODE_SAMPLES = extract_dslx_code_samples(PROMPT_MD_TEXT)
 SAMPLES_WITH_STUBS = create_samples_with_stubs()
 
 
-def run_on_single_file(binary: str, code_sample: str, more_flags: tuple[str, ...] = ()):
-    with tempfile.NamedTemporaryFile('w', suffix='.x', delete=False) as tmp:
-        tmp.write(code_sample)
-        tmp_filename = tmp.name
+@pytest.fixture(scope='session')
+def dslx_dir(tmp_path_factory) -> Path:
+    """Directory the DSLX modules under test are written to; pytest cleans it up."""
+    return tmp_path_factory.mktemp('dslx')
+
 
-    print(f'Running {binary} on {tmp_filename} ...')
+def run_on_single_file(binary: str, x_path: Path, code_sample: str, more_flags: tuple[str, ...] = ()):
+    x_path.write_text(code_sample)
+
+    print(f'Running {binary} on {x_path} ...')
     print('Contents:\n<<EOF\n', code_sample, '\n<<EOF\n', sep='')
 
     cmd = [binary]
     cmd.extend(list(more_flags))
-    cmd.append(tmp_filename)
+    cmd.append(str(x_path))
     cmd.append('--dslx_stdlib_path')
     cmd.append(os.environ['DSLX_STDLIB_PATH'])
 
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        assert result.returncode == 0, (
-            f"Non-zero exit code: {result.returncode}\n"
-            f"stdout:\n<<STDOUT\n{result.stdout}\nSTDOUT\n"
-            f"stderr:\n<<STDERR\n{result.stderr}\nSTDERR\n"
-        )
-    finally:
-        os.remove(tmp_filename)
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    assert result.returncode == 0, (
+        f"Non-zero exit code: {result.returncode}\n"
+        f"stdout:\n<<STDOUT\n{result.stdout}\nSTDOUT\n"
+        f"stderr:\n<<STDERR\n{result.stderr}\nSTDERR\n"
+    )
 
 
 @pytest.mark.parametrize('code_sample', PROMPT_CODE_SAMPLES)
-def test_prompt_code_sample(code_sample: str):
+def test_prompt_code_sample(code_sample: str, dslx_dir: Path):
     """Tests DSLX code samples in prompt by running through the interpreter."""
-    run_on_single_file('dslx_interpreter_main', code_sample, more_flags=('--compare=jit',))
+    # Prompt samples are unnamed; name the module after its content.
+    x_path = dslx_dir / f'prompt_{hashlib.sha256(code_sample.encode()).hexdigest()[:16]}.x'
+    run_on_single_file('dslx_interpreter_main', x_path, code_sample, more_flags=('--compare=jit',))
 
 
 @pytest.mark.parametrize('sample_with_stub', SAMPLES_WITH_STUBS, ids=lambda x: x.name)
-def test_samples_with_stub_typecheck(sample_with_stub: CodeSample):
+def test_samples_with_stub_typecheck(sample_with_stub: CodeSample, dslx_dir: Path):
     """Tests that DSLX tests pass with a stub signature."""
-    run_on_single_file('typecheck_main', sample_with_stub.content)
+    run_on_single_file('typecheck_main', dslx_dir / f'{sample_with_stub.name}.x', sample_with_stub.content)
 
 
 def test_prompt_size():
     """Tests tokens in prompt to check fit in context window."""
+    # Imported here so runs that deselect this test (e.g. `-k typecheck`)
+    # don't load the tokenizer extension.
+    import tiktoken
     encoding = tiktoken.encoding_for_model('gpt-4-turbo')
 
-    # Read the file
-    with open(PROMPT_MD_FILE, 'r', encoding='utf-8') as f:
-        text = f.read()
-
-    token_count = len(encoding.encode(text))
+    token_count = len(encoding.encode(PROMPT_MD_TEXT))
     print('token count:', token_count, file=sys.stderr)
 
     # Check we stay comfortably within a reasonable context window.